@@ -1,24 +1,105 @@
 """Export calendar domain entity state via iCalendar using the API."""
 
+import asyncio
+import gzip
 import logging
+import re
+import time
 
-from typing import Optional
+from functools import lru_cache
 from html import escape
 from http import HTTPStatus
 
 from aiohttp import web
 from datetime import datetime, timezone, timedelta
 import hashlib
+import hmac
 
 from homeassistant.components.http import HomeAssistantView
 from homeassistant.core import HomeAssistant
 from homeassistant.helpers.typing import ConfigType
 
-from .const import DOMAIN, CONTENT_TYPE_ICAL
+from .const import DOMAIN, CONTENT_TYPE_ICAL, CACHE_TTL
 
 
 _LOGGER = logging.getLogger(__name__)
 
+_CALENDAR_ENTITY_ID_RE = re.compile(r"\Acalendar\.[a-z0-9_]+\Z")
+
+# Static framing of every response, kept pre-encoded
+_ICAL_HEADER = (
+    b"BEGIN:VCALENDAR\n"
+    b"VERSION:2.0\n"
+    b"PRODID:-//Home Assistant//iCal Subscription 1.0//EN\n"
+    b"CALSCALE:GREGORIAN\n"
+    b"METHOD:PUBLISH\n"
+)
+_ICAL_FOOTER = b"END:VCALENDAR"
+
+
+# Matches html.escape(), plus the line continuation for embedded newlines
+_ICAL_TEXT_TABLE = str.maketrans({
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    '"': "&quot;",
+    "'": "&#x27;",
+    "\n": "\n ",
+})
+
+
+def _ical_text(value: str) -> str:
+    """Escape and fold a text value for an iCalendar property in one pass."""
+    return value.translate(_ICAL_TEXT_TABLE).rstrip()
+
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """Return whether an Accept-Encoding header allows a gzip response."""
+    qualities = {}
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+
+    # An explicit gzip entry wins over the wildcard, and q=0 refuses it
+    if "gzip" in qualities:
+        return qualities["gzip"] > 0
+    return qualities.get("*", 0.0) > 0
+
+
+@lru_cache(maxsize=4096)
+def _ical_datetime(value: str) -> str:
+    """Convert an ISO 8601 datetime string to an iCalendar UTC timestamp."""
+    # Timestamps already in UTC only need their separators dropped
+    if (
+        (len(value) == 25 and value.endswith("+00:00"))
+        or (len(value) == 20 and value[19] == "Z")
+    ) and value[4] == "-" and value[7] == "-" and value[10] == "T":
+        return (
+            f"{value[0:4]}{value[5:7]}{value[8:10]}"
+            f"T{value[11:13]}{value[14:16]}{value[17:19]}Z"
+        )
+    return (
+        datetime.fromisoformat(value)
+        .astimezone(timezone.utc)
+        .strftime("%Y%m%dT%H%M%SZ")
+    )
+
+
+@lru_cache(maxsize=4096)
+def _ical_date(value: str) -> str:
+    """Convert an ISO 8601 date string to an iCalendar date."""
+    if len(value) == 10 and value[4] == "-" and value[7] == "-":
+        return value.replace("-", "")
+    return datetime.strptime(value, "%Y-%m-%d").strftime("%Y%m%d")
+
 
 async def async_setup(hass: HomeAssistant, config: ConfigType) -> bool:
     """Set up the iCalendar component."""
@@ -34,74 +115,133 @@ async def async_setup(hass: HomeAssistant, config: ConfigType) -> bool:
 
     # Register the iCalendar HTTP view
     if calendars is not None:
-        hass.http.register_view(iCalendarView(hass, calendars, colours))
+        export = iCalendarExport(hass, calendars, colours)
+        hass.http.register_view(iCalendarView(export))
+        hass.http.register_view(iCalendarBatchView(export))
         return True
 
     return False
 
 
-class iCalendarView(HomeAssistantView):
-    """Define the iCalendar view."""
-
-    name = f"{DOMAIN}"
-    url = "/api/ics/{entity_id}"
+class iCalendarExport:
+    """Render configured calendars as iCalendar for the API views."""
 
-    def __init__(self, hass: HomeAssistant, calendars: dict, colours: Optional[dict]) -> None:
-        """Initialize the iCalendar view."""
+    def __init__(self, hass: HomeAssistant, calendars: dict, colours: dict | None) -> None:
+        """Initialize the iCalendar export."""
         self.hass = hass
         self.calendars = calendars
         self.colours = colours
-        self.requires_auth = False
 
-    async def get(self, request: web.Request, entity_id: str) -> web.Response:
-        """Handle an iCalendar view request."""
-        # Forbid empty secrets
-        if request.query.get("s") is None:
-            _LOGGER.error("Request was sent for entity '%s' without secret", entity_id)
-            return web.Response(body="403: Forbidden", status=HTTPStatus.FORBIDDEN)
+        # Rendered calendars by entity_id as (expiry, body, gzipped body, etag
+        # value). The gzipped body is only built once a client asks for it.
+        self._cache: dict[str, tuple[float, bytes, bytes | None, str]] = {}
+
+        # Index the config once so requests don't have to scan it. Only
+        # calendar entities with a secret are served, as
+        # entity_id -> (secret bytes, colour)
+        # A valid entity_id has nothing in it to escape, so it is used as is.
+        self._entities: dict[str, tuple[bytes, str | None]] = {}
+        for cal in calendars:
+            if not _CALENDAR_ENTITY_ID_RE.match(str(cal.get("entity_id", ""))):
+                _LOGGER.warning(
+                    "Ignoring calendar '%s' from config as it is not a valid calendar entity id",
+                    cal.get("entity_id"),
+                )
+                continue
+            if "secret" in cal:
+                self._entities[cal["entity_id"]] = (
+                    str(cal["secret"]).encode("utf-8"),
+                    cal.get("colour"),
+                )
 
-        # Find the calendar in config. Should be defined as per below or it will get denied.
-        # calendars:
-        #   - entity_id: calendar.entity
-        #     secret: secretpassword
-        valid_calendar = False
-        calendar_colour = None
-        for cal in self.calendars:
-            if (("entity_id" in cal) and (cal['entity_id'] == entity_id)) and ("secret" in cal):
-                valid_calendar = True
-                secret = cal['secret']
-                if("colour" in cal):
-                    calendar_colour = cal['colour']
-                break
-        
-        if valid_calendar is not True:
-            _LOGGER.error("Request was sent for entity '%s' which is not allowed by config", entity_id)
+        # Lets requests with an impossible secret be turned away straight away
+        self._secret_lengths = {len(secret) for secret, _ in self._entities.values()}
+        self._colour_map = {
+            c["name"]: c["colour"]
+            for c in (colours or [])
+            if "name" in c and "colour" in c
+        }
+
+    def authorize(
+        self, request: web.Request, entity_ids: list[str]
+    ) -> list[tuple[bytes, str | None]] | web.Response:
+        """Return the config of the requested calendars, or the response denying access."""
+        # Forbid empty secrets
+        query_secret = request.query.get("s")
+        if query_secret is None:
+            _LOGGER.error("Request was sent for entity '%s' without secret", ", ".join(entity_ids))
             return web.Response(body="403: Forbidden", status=HTTPStatus.FORBIDDEN)
 
-        # Only return anything with the secret supplied
-        if str(request.query.get("s")) != str(secret):
+        # No configured secret has this length, so it cannot be valid
+        query_secret = query_secret.encode("utf-8")
+        if len(query_secret) not in self._secret_lengths:
             _LOGGER.error(
-                "Request was sent for entity '%s' with invalid secret", entity_id
+                "Request was sent for entity '%s' with invalid secret", ", ".join(entity_ids)
             )
             return web.Response(
                 body="401: Unauthorized", status=HTTPStatus.UNAUTHORIZED
             )
 
-        # Only return calendars
-        if not entity_id.startswith("calendar."):
-            _LOGGER.error("Entity '%s' is not a calendar", entity_id)
-            return web.Response(body="403: Forbidden", status=HTTPStatus.FORBIDDEN)
-
-        # Check if the calendar entity exists
-        self._state = self.hass.states.get(entity_id)
-        if self._state is None:
-            _LOGGER.error("Entity '%s' could not be found", entity_id)
-            return web.Response(body="404: Not Found", status=HTTPStatus.NOT_FOUND)
+        # Find the calendars in config. Should be defined as per below or they will get denied.
+        # calendars:
+        #   - entity_id: calendar.entity
+        #     secret: secretpassword
+        # Non-calendar entities are never indexed, so they are denied here too.
+        entities = []
+        for entity_id in entity_ids:
+            entity = self._entities.get(entity_id)
+            if entity is None:
+                _LOGGER.error("Request was sent for entity '%s' which is not allowed by config", entity_id)
+                return web.Response(body="403: Forbidden", status=HTTPStatus.FORBIDDEN)
+
+            # Only return anything with the secret supplied
+            if not hmac.compare_digest(query_secret, entity[0]):
+                _LOGGER.error(
+                    "Request was sent for entity '%s' with invalid secret", entity_id
+                )
+                return web.Response(
+                    body="401: Unauthorized", status=HTTPStatus.UNAUTHORIZED
+                )
 
+            entities.append(entity)
+
+        return entities
+
+    def cached_response(self, request: web.Request, key: str) -> web.Response | None:
+        """Return the cached calendar for key if it has not expired yet."""
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return self.ical_response(request, key)
+        return None
+
+    async def async_load(
+        self, entity_ids: list[str], now: datetime
+    ) -> tuple[list, list] | web.Response:
+        """Return the states and events of calendars, or a 404 if one is missing."""
+        # Check if the calendar entities exist
+        states = [self.hass.states.get(entity_id) for entity_id in entity_ids]
+        for entity_id, state in zip(entity_ids, states):
+            if state is None:
+                _LOGGER.error("Entity '%s' could not be found", entity_id)
+                return web.Response(body="404: Not Found", status=HTTPStatus.NOT_FOUND)
+
+        # Fetch the events of all calendars at once
+        results = await asyncio.gather(
+            *(self._async_get_events(entity_id, now) for entity_id in entity_ids)
+        )
+        for entity_id, events in zip(entity_ids, results):
+            if events is None:
+                _LOGGER.error("Entity '%s' has no events", entity_id)
+                return web.Response(body="404: Not Found", status=HTTPStatus.NOT_FOUND)
+
+        return states, results
+
+    async def _async_get_events(self, entity_id: str, now: datetime) -> list | None:
+        """Fetch the events of a calendar entity, or None if it has none."""
         # Calculate the start and end timeframe for our calendar
         # We output 4 weeks history and 52 weeks into the future
-        start = (datetime.now() - timedelta(weeks=4)).strftime("%Y-%m-%d %H:%M:%S")
-        end = (datetime.now() + timedelta(weeks=52)).strftime("%Y-%m-%d %H:%M:%S")
+        start = (now - timedelta(weeks=4)).isoformat(sep=" ", timespec="seconds")
+        end = (now + timedelta(weeks=52)).isoformat(sep=" ", timespec="seconds")
 
         events = await self.hass.services.async_call('calendar', 'get_events',
               { "entity_id": entity_id,
@@ -110,87 +250,233 @@ class iCalendarView(HomeAssistantView):
               }, blocking=True, return_response=True)
 
         if(events is None) or (entity_id not in events):
-            _LOGGER.error("Entity '%s' has no events", entity_id)
-            return web.Response(body="404: Not Found", status=HTTPStatus.NOT_FOUND)
-
-        events = events[entity_id]['events']
-
-        # Craft the iCalendar response
-        response = "BEGIN:VCALENDAR\n"
-        response += "VERSION:2.0\n"
-        response += "PRODID:-//Home Assistant//iCal Subscription 1.0//EN\n"
-        response += "CALSCALE:GREGORIAN\n"
-        response += "METHOD:PUBLISH\n"
-        response += f"ORGANIZER;CN=\"{escape(self._state.attributes['friendly_name'])}\":MAILTO:{entity_id}@homeassistant.local\n"
-        response += f"NAME:{escape(self._state.attributes['friendly_name'])}\n"
-        response += f"X-WR-CALNAME:{escape(self._state.attributes['friendly_name'])}\n"
-        if calendar_colour is not None:
-            response += f"COLOR:{calendar_colour}\n"
-
-        # Generate the variables
-        entity_id = escape(entity_id)
-        dtstamp = datetime.now(tz=timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+            return None
+
+        return events[entity_id]['events']
+
+    def render_events(
+        self,
+        parts: list[str],
+        events: list,
+        entity_id: str,
+        dtstamp: str,
+        calendar_colour: str | None = None,
+    ) -> None:
+        """Append a VEVENT for each event to the iCalendar response parts."""
+        # Bind everything the loop calls per event to locals
+        _escape = escape
+        _datetime = _ical_datetime
+        _date = _ical_date
+        _text = _ical_text
+        colour_for = self._colour_map.get
+        append = parts.append
+        uid_prefix = hashlib.blake2b(
+            f"{entity_id}-".encode(), digest_size=16
+        )
 
         # Iterate through all the events
         for e in events:
-            try:
-                start = datetime.fromisoformat(e["start"]).astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
-                end = datetime.fromisoformat(e["end"]).astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
-            except:
-                start = datetime.strptime(
-                    e["start"], "%Y-%m-%d"
-                ).strftime("%Y%m%d")
-                end = datetime.strptime(
-                    e["end"], "%Y-%m-%d"
-                ).strftime("%Y%m%d")
+            # Timed events carry a "T" separator, all-day events are plain dates
+            if len(e["start"]) > 10 and e["start"][10] == "T":
+                start = _datetime(e["start"])
+                end = _datetime(e["end"])
+                dtstart, dtend = "\nDTSTART:", "\nDTEND:"
+            else:
+                start = _date(e["start"])
+                end = _date(e["end"])
+                dtstart, dtend = "\nDTSTART;VALUE=DATE:", "\nDTEND;VALUE=DATE:"
 
             # Create and hash the UID
             if ("summary" in e and e["summary"] is not None):
-                summary = escape(e['summary'])
+                summary = _escape(e['summary'])
             else:
                 summary = None
 
-            uid = f"{entity_id}-{start}-{end}-{summary}"
-            uid = hashlib.sha256(uid.encode('utf-8')).hexdigest()
+            # Hashes "{entity_id}-{start}-{end}-{summary}", resuming from the
+            # state that has already absorbed the entity_id
+            uid_hash = uid_prefix.copy()
+            uid_hash.update(f"{start}-{end}-{summary}".encode())
+            uid = uid_hash.hexdigest()
 
-            response += "BEGIN:VEVENT\n"
-
-            response += f"UID:{uid}\n"
-            response += f"DTSTAMP:{dtstamp}\n"
-            response += f"DTSTART:{start}\n"
-            response += f"DTEND:{end}\n"
+            append(
+                f"BEGIN:VEVENT\nUID:{uid}\nDTSTAMP:{dtstamp}"
+                f"{dtstart}{start}{dtend}{end}\n"
+            )
 
             # Add available optional attributes to the iCalendar response
             if summary is not None:
-                response += f"SUMMARY:{summary.replace('\n', '\n ').rstrip()}\n"
+                append("SUMMARY:" + summary.replace("\n", "\n ").rstrip() + "\n")
 
             if (
                 "description" in e
                 and e["description"] is not None
             ):
-                response += (
-                    f"DESCRIPTION:{escape(e['description']).replace('\n', '\n ').rstrip()}\n"
-                )
+                append(f"DESCRIPTION:{_text(e['description'])}\n")
 
             if (
                 "location" in e
                 and e["location"] is not None
             ):
-                response += f"LOCATION:{escape(e['location']).replace('\n', '\n ').rstrip()}\n"
+                append(f"LOCATION:{_text(e['location'])}\n")
 
             # Set colour for event, defined in config as per below:
             # colours:
             #   - name: "Calendar Event Summary"
             #     colour: css3 colour name
-            for c in self.colours:
-                if ("name" in c) and (c['name'] == summary):
-                    response += f"COLOR:{c['colour']}\n"
+            colour = colour_for(summary, calendar_colour)
+            if colour is not None:
+                append(f"COLOR:{colour}\n")
 
             # Finish up this calendar entry
-            response += "END:VEVENT\n"
+            append("END:VEVENT\n")
+
+    def cache_body(self, key: str, body: bytes, dtstamp: str) -> None:
+        """Cache a rendered calendar alongside its ETag."""
+        # DTSTAMP changes on every render, so it is left out of the ETag. That
+        # keeps the ETag stable while the events are unchanged, which makes it
+        # a weak one.
+        content = body.replace(f"\nDTSTAMP:{dtstamp}".encode(), b"\nDTSTAMP:")
+        etag = hashlib.blake2b(content, digest_size=8).hexdigest()
+
+        # Drop expired calendars so combinations nobody polls any more go away
+        now = time.monotonic()
+        for expired in [k for k, v in self._cache.items() if v[0] <= now]:
+            del self._cache[expired]
+
+        self._cache[key] = (now + CACHE_TTL, body, None, etag)
+
+    def ical_response(self, request: web.Request, key: str) -> web.Response:
+        """Return a cached calendar, or 304 if the client already has it."""
+        expiry, body, gzip_body, etag = self._cache[key]
+        headers = {"Vary": "Accept-Encoding"}
+
+        # Calendar clients generally accept gzip, which shrinks the body a lot
+        use_gzip = _accepts_gzip(request.headers.get("Accept-Encoding", ""))
+        response_etag = f"{etag}-gzip" if use_gzip else etag
+        headers["ETag"] = f'W/"{response_etag}"'
+
+        # If-None-Match always compares weakly, and "*" matches any calendar
+        if any(
+            tag.value in (response_etag, "*") for tag in request.if_none_match or ()
+        ):
+            return web.Response(status=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+        if use_gzip:
+            # Compress on first use and keep it for the rest of the TTL
+            if gzip_body is None:
+                gzip_body = gzip.compress(body, compresslevel=6)
+                self._cache[key] = (expiry, body, gzip_body, etag)
+            body = gzip_body
+            headers["Content-Encoding"] = "gzip"
+
+        return web.Response(
+            body=body,
+            headers=headers,
+            content_type=CONTENT_TYPE_ICAL,
+            charset="utf-8",
+        )
+
+
+class iCalendarView(HomeAssistantView):
+    """Define the iCalendar view."""
+
+    name = f"{DOMAIN}"
+    url = "/api/ics/{entity_id}"
+
+    def __init__(self, export: iCalendarExport) -> None:
+        """Initialize the iCalendar view."""
+        self.export = export
+        self.requires_auth = False
+
+    async def get(self, request: web.Request, entity_id: str) -> web.Response:
+        """Handle an iCalendar view request."""
+        entities = self.export.authorize(request, [entity_id])
+        if isinstance(entities, web.Response):
+            return entities
+        ((_, calendar_colour),) = entities
+
+        # Serve a recently rendered calendar if we have one
+        response = self.export.cached_response(request, entity_id)
+        if response is not None:
+            return response
+
+        now = datetime.now()
+        loaded = await self.export.async_load([entity_id], now)
+        if isinstance(loaded, web.Response):
+            return loaded
+        (state,), (events,) = loaded
+
+        # Craft the iCalendar response
+        friendly_name = escape(state.attributes['friendly_name'])
+        parts: list[str] = []
+        append = parts.append
+        append(f"ORGANIZER;CN=\"{friendly_name}\":MAILTO:{entity_id}@homeassistant.local\n")
+        append(f"NAME:{friendly_name}\n")
+        append(f"X-WR-CALNAME:{friendly_name}\n")
+        if calendar_colour is not None:
+            append(f"COLOR:{calendar_colour}\n")
+
+        dtstamp = now.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        self.export.render_events(parts, events, entity_id, dtstamp)
 
         # Finish up the iCalendar response
-        response += "END:VCALENDAR"
+        body = b"".join((_ICAL_HEADER, "".join(parts).encode("utf-8"), _ICAL_FOOTER))
+        self.export.cache_body(entity_id, body, dtstamp)
+        return self.export.ical_response(request, entity_id)
+
+
+class iCalendarBatchView(HomeAssistantView):
+    """Define the view combining several calendars into one iCalendar."""
+
+    name = f"{DOMAIN}:batch"
+    url = "/api/ics_batch"
 
-        # Return the iCalendar response
-        return web.Response(body=response, content_type=CONTENT_TYPE_ICAL)
+    def __init__(self, export: iCalendarExport) -> None:
+        """Initialize the batch iCalendar view."""
+        self.export = export
+        self.requires_auth = False
+
+    async def get(self, request: web.Request) -> web.Response:
+        """Handle a combined iCalendar view request."""
+        # Calendars are requested as ?ids=calendar.one,calendar.two. They are
+        # sorted so every ordering of the same calendars shares one cache entry.
+        entity_ids = sorted({
+            entity_id for entity_id in request.query.get("ids", "").split(",") if entity_id
+        })
+        if not entity_ids:
+            _LOGGER.error("Batch request was sent without any entities")
+            return web.Response(body="403: Forbidden", status=HTTPStatus.FORBIDDEN)
+
+        entities = self.export.authorize(request, entity_ids)
+        if isinstance(entities, web.Response):
+            return entities
+
+        # Serve a recently rendered calendar if we have one
+        cache_key = ",".join(entity_ids)
+        response = self.export.cached_response(request, cache_key)
+        if response is not None:
+            return response
+
+        now = datetime.now()
+        loaded = await self.export.async_load(entity_ids, now)
+        if isinstance(loaded, web.Response):
+            return loaded
+        states, results = loaded
+
+        # Craft the iCalendar response, colouring events by their calendar
+        friendly_name = escape(", ".join(
+            state.attributes['friendly_name'] for state in states
+        ))
+        parts: list[str] = [f"NAME:{friendly_name}\n"]
+        parts.append(f"X-WR-CALNAME:{friendly_name}\n")
+
+        dtstamp = now.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        for entity_id, (_, calendar_colour), events in zip(entity_ids, entities, results):
+            self.export.render_events(
+                parts, events, entity_id, dtstamp, calendar_colour
+            )
+
+        # Finish up the iCalendar response
+        body = b"".join((_ICAL_HEADER, "".join(parts).encode("utf-8"), _ICAL_FOOTER))
+        self.export.cache_body(cache_key, body, dtstamp)
+        return self.export.ical_response(request, cache_key)
@@ -4,3 +4,6 @@ NAME = "iCalendar API"
 DOMAIN = "icalendar"
 
 CONTENT_TYPE_ICAL = "text/calendar"
+
+# Seconds a rendered calendar is served from memory before being rebuilt
+CACHE_TTL = 300